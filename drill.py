@@ -2,10 +2,26 @@
 
 import argparse
 import datetime
+import math
+import os
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.spatial import cKDTree
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+TOKEN = re.compile(r"([A-Z])([^A-Z]*)")
 
 
 class Point:
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -35,6 +51,36 @@ class Point:
         return hash((self.x, self.y))
 
 
+class PointArray:
+    """Points stored as separate x and y coordinate arrays"""
+
+    def __init__(self, xs, ys):
+        self.xs = np.asarray(xs, dtype=np.float64)
+        self.ys = np.asarray(ys, dtype=np.float64)
+
+    @classmethod
+    def from_pairs(cls, pairs: list):
+        xy = np.array(pairs, dtype=np.float64).reshape(-1, 2)
+        return cls(xy[:, 0], xy[:, 1])
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return Point(float(self.xs[index]), float(self.ys[index]))
+        return PointArray(self.xs[index], self.ys[index])
+
+    def __iter__(self):
+        return map(Point, self.xs.tolist(), self.ys.tolist())
+
+    def __str__(self):
+        return str(list(self))
+
+    def __repr__(self):
+        return self.__str__()
+
+
 def parse_number(number: str):
     if number == "":
         return 0
@@ -42,27 +88,18 @@ def parse_number(number: str):
 
 
 def parse_command(line: str):
-    command = {}
-    last_point = "?"
-    for ch in line:
-        if ch.isalpha():
-            last_point = ch
-            command[ch] = ""
-        else:
-            command[last_point] += ch
-    coord = {}
-    for key in command:
-        if key in ["X", "Y", "I", "J"]:
-            coord[key] = parse_number(command[key])
-
-    p = Point(coord.get("X", 0), coord.get("Y", 0))
+    command = dict(TOKEN.findall(line))
+    x = parse_number(command.get("X", ""))
+    y = parse_number(command.get("Y", ""))
     code = "G" + command.get("G", "00")  # default to travel
 
-    return {code: p}
+    return code, x, y
 
 
 def parse_drl(file_path: str):
+    """Parse a drill file into a list of tools, merged and sorted by diameter"""
     drill_mode = False
+    diameters = {}
     tools = {}
     selected_tool = None
     with open(file_path, "r") as file:
@@ -77,53 +114,121 @@ def parse_drl(file_path: str):
                     if "C" in line:
                         params = line.split("C")
                         t = int(params[0][1:])
-                        tools[t] = {
-                            "diameter": float(params[1]),
-                            "points": [],
-                            "paths": [],
-                        }
+                        diameter = float(params[1])
+                        diameters[t] = diameter
+                        tools.setdefault(
+                            diameter,
+                            {"diameter": diameter, "points": [], "paths": []},
+                        )
                     else:
-                        selected_tool = int(line[1:])
+                        t = int(line[1:])
+                        selected_tool = tools[diameters[t]] if t in diameters else None
                     continue
                 if line.startswith("G05"):
                     drill_mode = True
                     continue
                 if line.startswith("M15"):
                     # Plunge
-                    tools[selected_tool]["paths"].append({"M15": ""})
+                    selected_tool["paths"].append(("M15", None, None))
                     continue
                 if line.startswith("M16"):
                     # Retract
-                    tools[selected_tool]["paths"].append({"M16": ""})
+                    selected_tool["paths"].append(("M16", None, None))
                     continue
                 if line.startswith(("G00", "G01")):
                     drill_mode = False
                     parsed = parse_command(line)
-                    tools[selected_tool]["paths"].append(parsed)
+                    selected_tool["paths"].append(parsed)
                     continue
                 if line.startswith(("X", "Y")) and drill_mode:
-                    _, p = parse_command(line).popitem()
-                    tools[selected_tool]["points"].append(p)
+                    _, x, y = parse_command(line)
+                    selected_tool["points"].append((x, y))
                     continue
             except Exception as e:
                 print(f"Error parsing line({line_no}): {line}")
                 print(e)
                 raise e
-    return tools
-
-
-def sort_points(points: list, entry: Point):
+    for tool in tools.values():
+        tool["points"] = PointArray.from_pairs(tool["points"])
+    return [tools[diameter] for diameter in sorted(tools)]
+
+
+def _nn_order_scan(xs, ys, cx, cy):
+    """Greedy nearest neighbour order by brute force scan, only used compiled"""
+    n = xs.shape[0]
+    order = np.empty(n, dtype=np.int64)
+    # unvisited points are kept packed at the front, removed by swapping
+    # the last one into their slot
+    rx = xs.copy()
+    ry = ys.copy()
+    ri = np.arange(n)
+    for k in range(n):
+        left = n - k
+        best_j = 0
+        best_d = 0.0
+        for j in range(left):
+            dx = rx[j] - cx
+            dy = ry[j] - cy
+            # compare the rounded distances, like Point.dist, so that
+            # geometrically equal ones tie instead of float noise deciding
+            d = math.sqrt(dx * dx + dy * dy)
+            # ties go to the lowest original index, as swapping reorders
+            if j == 0 or d < best_d or (d == best_d and ri[j] < ri[best_j]):
+                best_j = j
+                best_d = d
+        order[k] = ri[best_j]
+        cx = rx[best_j]
+        cy = ry[best_j]
+        rx[best_j] = rx[left - 1]
+        ry[best_j] = ry[left - 1]
+        ri[best_j] = ri[left - 1]
+    return order
+
+
+def _nn_order_kdtree(xs, ys, cx, cy):
+    """Greedy nearest neighbour order using a KD-tree"""
+    pts = np.column_stack((xs, ys))
+    tree = cKDTree(pts)
+    visited = np.zeros(len(pts), dtype=bool)
+    order = []
+    current = (cx, cy)
+    while len(order) < len(pts):
+        # query the nearest k points, growing k until an unvisited one shows up
+        k = min(32, len(pts))
+        while True:
+            _, idx = tree.query(current, k=k)
+            idx = np.atleast_1d(idx)
+            unvisited = idx[~visited[idx]]
+            if len(unvisited) > 0:
+                break
+            k = min(k * 2, len(pts))
+        # the tree gives no order between equal distances, so collect all
+        # the points about as close and take the lowest index among them
+        d = np.hypot(*(pts[unvisited[0]] - current))
+        near = np.asarray(tree.query_ball_point(current, d * (1 + 1e-9)), dtype=int)
+        near = near[~visited[near]]
+        dx = xs[near] - current[0]
+        dy = ys[near] - current[1]
+        i = near[np.lexsort((near, np.sqrt(dx * dx + dy * dy)))[0]]
+        visited[i] = True
+        order.append(i)
+        current = pts[i]
+    return order
+
+
+if njit is not None:
+    # no fastmath, contracting the distances would change which ones tie
+    _nn_order = njit(cache=True)(_nn_order_scan)
+else:
+    _nn_order = _nn_order_kdtree
+
+
+def sort_points(points: PointArray, entry: Point):
+    """Greedy nearest neighbour tour through `points`, starting from `entry`"""
     if len(points) == 0:
-        return []
-    sorted_points = []
-    points = points.copy()
-    current = entry
-    while len(points) > 0:
-        next_point = min(points, key=lambda p: current.dist(p))
-        sorted_points.append(next_point)
-        points.remove(next_point)
-        current = next_point
-    return sorted_points
+        return points
+    order = _nn_order(points.xs, points.ys, float(entry.x), float(entry.y))
+    return points[order]
 
 
 def tool_change(t: int, d: float, args):
@@ -133,26 +238,23 @@ def tool_change(t: int, d: float, args):
     return output
 
 
-def generate_drill_gcode(p: Point, args):
-    output = f"G00 X{p.x} Y{p.y}\n"
-    output += f"G00 Z{args.start}\n"
-    output += f"G01 Z{args.end}\n"
-    output += f"G00 Z{args.retract}\n"
-    return output
+def drill_cycle(args):
+    """Z moves for drilling a hole, the same for every hole in the job"""
+    return f"G00 Z{args.start}\nG01 Z{args.end}\nG00 Z{args.retract}\n"
 
 
-def generate_bore_gcode(p: Point, args, diameter: float, floor=False):
+def bore_cycle(args, diameter: float, floor=False):
+    """Helical bore in relative moves, the same for every hole of a tool"""
     path_r = (diameter - args.max_tool / 2) / 2
-    offset = path_r + args.max_tool / 2
     pitch = args.bore_pitch
+    pitch_line = f"G3 Z{-pitch} I{path_r}\n"
 
-    output = f"G00 X{p.x - offset} Y{p.y}\n"
-    output += f"G00 Z{args.start}\n"
+    output = f"G00 Z{args.start}\n"
 
     output += "G91; Switch to relative positioning\n"
     remaining = args.start - args.end
     while remaining - pitch > 0:
-        output += f"G3 Z{-pitch} I{path_r}\n"
+        output += pitch_line
         remaining -= pitch
     output += f"G3 Z{-remaining} I{path_r}\n"
     output += "G90; Switch back to absolute positioning\n"
@@ -163,8 +265,20 @@ def generate_bore_gcode(p: Point, args, diameter: float, floor=False):
     return output
 
 
+def generate_drill_gcode(p: Point, cycle: str):
+    return f"G00 X{p.x} Y{p.y}\n" + cycle
+
+
+def generate_bore_gcode(p: Point, args, diameter: float, cycle: str):
+    path_r = (diameter - args.max_tool / 2) / 2
+    offset = path_r + args.max_tool / 2
+    return f"G00 X{p.x - offset} Y{p.y}\n" + cycle
+
+
 def generate_gcode(tools, args, file_path=None, bore=False):
-    output = f"""; Generated on {datetime.datetime.now()}
+    file_path = file_path or args.output
+    with open(file_path, "w", buffering=1 << 20) as file:
+        file.write(f"""; Generated on {datetime.datetime.now()}
 ; Command: `{" ".join(sys.argv)}`
 G21; Set units to mm
 G90; Set absolute positioning
@@ -173,33 +287,39 @@ G94; Set feedrate to mm/min
 G40; Disable tool radius compensation
 G49; Disable tool length offset
 G01 F{args.feed}; Set feedrate to {args.feed} mm/min
-"""
+""")
 
-    output += f"G00 Z{args.retract}\n"
+        file.write(f"G00 Z{args.retract}\n")
 
-    for t, tool in tools.items():
-        output += tool_change(t, tool["diameter"], args)
-        for p in tool["points"]:
+        for t, tool in tools.items():
+            file.write(tool_change(t, tool["diameter"], args))
             if bore:
-                output += generate_bore_gcode(p, args, tool["diameter"])
+                cycle = bore_cycle(args, tool["diameter"])
+                for p in tool["points"]:
+                    file.write(generate_bore_gcode(p, args, tool["diameter"], cycle))
             else:
-                output += generate_drill_gcode(p, args)
+                cycle = drill_cycle(args)
+                for p in tool["points"]:
+                    file.write(generate_drill_gcode(p, cycle))
 
-        for path in tool["paths"]:
-            for code in path:
+            for code, x, y in tool["paths"]:
                 if code == "M15":
-                    output += f"G00 Z{args.start}\n"
-                    output += f"G01 Z{args.end}\n"
+                    file.write(f"G00 Z{args.start}\n")
+                    file.write(f"G01 Z{args.end}\n")
                 elif code == "M16":
-                    output += f"G00 Z{args.retract}\n"
+                    file.write(f"G00 Z{args.retract}\n")
                 else:
-                    output += f"{code} X{path[code].x} Y{path[code].y}\n"
+                    file.write(f"{code} X{x} Y{y}\n")
 
-    output += "M5; Stop spindle\n"
-    output += "M30; End of program\n"
-    file_path = file_path or args.output
-    with open(file_path, "w") as file:
-        file.write(output)
+        file.write("M5; Stop spindle\n")
+        file.write("M30; End of program\n")
+
+
+def _emit_one(op):
+    """Sort and write a single tool to its own file"""
+    t, tool, args, file_path, bore = op
+    tool["points"] = sort_points(tool["points"], Point(*args.entry))
+    generate_gcode({t: tool}, args, file_path, bore=bore)
 
 
 if __name__ == "__main__":
@@ -245,32 +365,13 @@ if __name__ == "__main__":
         args.output = ".".join(args.input.split(".")[0:-1]) + ".nc"
         print(f"Output file not specified, using `{args.output}`")
 
-    tools = parse_drl(args.input)
+    tools = {i + 1: tool for i, tool in enumerate(parse_drl(args.input))}
     for tool in tools:
         print(f"Tool: {tool}")
         print(f"Diameter: {tools[tool]['diameter']}")
         print(f"Points({len(tools[tool]['points'])}): {tools[tool]['points']}")
         print(f"Paths({len(tools[tool]['paths'])}): {tools[tool]['paths']}")
 
-    # merge tools with the same diameter
-    merged_tools = {}
-    for tool in tools:
-        diameter = tools[tool]["diameter"]
-        if diameter not in merged_tools:
-            merged_tools[diameter] = {"points": [], "paths": [], "diameter": diameter}
-        merged_tools[diameter]["points"].extend(tools[tool]["points"])
-        merged_tools[diameter]["paths"].extend(tools[tool]["paths"])
-
-    # replace diameter with tool number
-    tools = {}
-    for i, diameter in enumerate(merged_tools):
-        tools[i + 1] = merged_tools[diameter]
-        tools[i + 1]["diameter"] = diameter
-
-    # sort points
-    for tool in tools:
-        tools[tool]["points"] = sort_points(tools[tool]["points"], Point(*args.entry))
-
     if args.split:
         path = args.output.split(".")
         suffix = path[-1]
@@ -278,15 +379,25 @@ if __name__ == "__main__":
 
         ops = []
         for tool in tools:
-            ops.append((tool, tools[tool]["diameter"] > args.max_tool))
-
-        for tool, bore in ops:
             d = tools[tool]["diameter"]
-            generate_gcode(
-                {tool: tools[tool]},
-                args,
-                f"{file_path}_T{tool}({d}mm).{suffix}",
-                bore=bore,
+            ops.append(
+                (
+                    tool,
+                    tools[tool],
+                    args,
+                    f"{file_path}_T{tool}({d}mm).{suffix}",
+                    d > args.max_tool,
+                )
             )
+
+        # each tool is sorted and written to its own file independently
+        workers = max(1, min(len(ops), os.cpu_count() or 1))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_emit_one, ops))
     else:
+        # sort points
+        for tool in tools:
+            tools[tool]["points"] = sort_points(
+                tools[tool]["points"], Point(*args.entry)
+            )
         generate_gcode(tools, args, args.output)
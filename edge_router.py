@@ -1,79 +1,108 @@
 #!/usr/bin/env python
 
 import argparse
+from dataclasses import dataclass
+from itertools import starmap
+import shapely
+from shapely import STRtree
 from shapely.geometry import Polygon
 import numpy as np
-import cmath
+import logging
+import math
+import mmap
+import re
 import sys
 import datetime
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+log = logging.getLogger(__name__)
 
 FMT = (4, 6)
 UNIT = "mm"
+_INV_SCALE = 1.0 / 10 ** FMT[1]  # Gerber integer coordinates to units
 
 TOLERANCE = 1 / (2**6)  # 1/64 mm
+CHORD_TOLERANCE = 1 / (2**6)  # 1/64 mm, max deviation of outlines and corners
 
+# Edge kinds
+LINE = 0
+CW_ARC = 1
+CCW_ARC = 2
 
-class Within:
-    def __init__(self, o):
-        self.o = o
-
-    def __lt__(self, other):
-        return self.o.within(other.o)
-
+# a modal G01-G03 block, or a coordinate block (optionally with its own G
+# code and each of X, Y, I and J optional), anything else that looks like a
+# coordinate block is captured as the last group so that it is not skipped
+COMMAND = re.compile(
+    rb"^(?:G0?([1-3])\*|(?:G0?([1-3]))?(?=[XYIJ])"
+    rb"(?:X([+-]?\d+))?(?:Y([+-]?\d+))?(?:I([+-]?\d+))?(?:J([+-]?\d+))?D(\d+)\*"
+    rb"|((?:G0?[1-3])?[XYIJ].*?))\r?$",
+    re.M,
+)
 
-def parse_number(coordinate: str):
-    return float(coordinate) / 10 ** FMT[1]
 
-
-def parse_command(code: str, line: str):
-    command = {"code": code}
-    last_point = "?"
-    for ch in line:
-        if ch.isalpha():
-            last_point = ch
-            command[ch] = ""
-        else:
-            command[last_point] += ch
-    for key in command:
-        if key in ["X", "Y", "I", "J"]:
-            command[key] = parse_number(command[key])
-    return command
+def parse_number(coordinate):
+    return np.asarray(coordinate, dtype=np.float64) * _INV_SCALE
 
 
 def parse_gerber(file_path: str):
-    commands = []
-    with open(file_path, "r") as file:
+    """
+    Parse the coordinate blocks of a Gerber file.
+
+    :param file_path: Gerber file path
+    :return: Arrays of the modal G code (1-3), the D code and the X, Y, I, J
+        coordinates of each block
+    """
+    global FMT, _INV_SCALE
+    with open(file_path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        header = re.search(rb"^G04 Gerber.*$", data, re.M)
+        if header:
+            # G04 Gerber Fmt 4.6, Leading zero omitted, Abs format (unit mm)*
+            options = header.group(0).decode().strip()[0:-1].split(", ")
+            for option in options:
+                if "Fmt" in option:
+                    FMT = tuple(map(int, option.split(" ")[-1].split(".")))
+                    _INV_SCALE = 1.0 / 10 ** FMT[1]
+                    print(f"Setting FMT to {FMT}")
+                if "unit" in option:
+                    UNIT = option.split(" ")[-1][0:-1]
+                    print(f"Setting UNIT to {UNIT}")
+
+        codes = []
+        ds = []
+        values = []
         last_command = None
-        for line in file:
-            line = line.strip()[0:-1]
-            if line.startswith("%"):
+        # omitted X or Y keep their value from the previous block
+        last_x = last_y = b"0"
+        for code, block_code, x, y, i, j, d, bad in COMMAND.findall(data):
+            if bad:
+                raise ValueError(f"Unsupported block {bad.decode()}")
+            if code:
+                last_command = int(code)
                 continue
-            if line.startswith("G04 Gerber"):
-                # G04 Gerber Fmt 4.6, Leading zero omitted, Abs format (unit mm)*
-                options = line.split(", ")
-                for option in options:
-                    if "Fmt" in option:
-                        FMT = tuple(map(int, option.split(" ")[-1].split(".")))
-                        print(f"Setting FMT to {FMT}")
-                    if "unit" in option:
-                        UNIT = option.split(" ")[-1][0:-1]
-                        print(f"Setting UNIT to {UNIT}")
-                continue
-            if line.startswith("G04"):
-                continue
-            if line.startswith("G"):
-                last_command = line
-                continue
-            if line.startswith("X"):
-                assert last_command is not None
-                parsed = parse_command(last_command, line)
-                commands.append(parsed)
-                continue
-    return commands
+            if block_code:
+                last_command = int(block_code)
+            assert last_command is not None
+            last_x = x or last_x
+            last_y = y or last_y
+            codes.append(last_command)
+            ds.append(int(d))
+            values.append((last_x, last_y, i or b"0", j or b"0"))
+
+    # convert every coordinate at once
+    coords = parse_number(np.array(values, dtype=np.bytes_).astype(np.int64))
+    return np.array(codes, dtype=np.int8), np.array(ds), coords.reshape(-1, 4)
 
 
 class Point:
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         if TOLERANCE > 0:
             x = round(x / TOLERANCE) * TOLERANCE
@@ -109,221 +138,184 @@ class Point:
         return Point(self.x / r, self.y / r)
 
 
-class Line:
-    def __init__(self, start: Point, end: Point):
-        self.start = start
-        self.end = end
-
-    def __str__(self):
-        return f"Line({self.start}, {self.end})"
-
-
-class Arc:
-    def __init__(self, start: Point, end: Point, center: Point, clockwise: bool):
-        self.start = start
-        self.end = end
-        self.center = center
-        self.clockwise = clockwise
-
-    def __str__(self):
-        return f"Arc{self.start}, {self.end}, {self.center}, {self.clockwise})"
+@dataclass
+class EdgeArray:
+    """Edges stored as parallel arrays, one row per edge"""
+
+    starts: np.ndarray  # (N, 2)
+    ends: np.ndarray  # (N, 2)
+    centers: np.ndarray  # (N, 2), only used by arcs
+    kinds: np.ndarray  # (N,) LINE, CW_ARC or CCW_ARC
+
+    @classmethod
+    def polyline(cls, coords):
+        """Lines joining consecutive rows of `coords`"""
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        n = max(len(coords) - 1, 0)
+        return cls(
+            coords[:-1], coords[1:], np.zeros((n, 2)), np.full(n, LINE, dtype=np.int8)
+        )
+
+    @classmethod
+    def concatenate(cls, arrays: list):
+        return cls(
+            np.concatenate([a.starts for a in arrays]),
+            np.concatenate([a.ends for a in arrays]),
+            np.concatenate([a.centers for a in arrays]),
+            np.concatenate([a.kinds for a in arrays]),
+        )
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index):
+        return EdgeArray(
+            self.starts[index], self.ends[index], self.centers[index], self.kinds[index]
+        )
+
+    def take(self, order: list, reverse: list):
+        """Edges in `order`, with the ones flagged in `reverse` flipped around"""
+        edges = self[np.asarray(order, dtype=np.intp)]
+        flip = np.asarray(reverse, dtype=bool)
+        kinds = edges.kinds.copy()
+        arcs = flip & (kinds != LINE)
+        kinds[arcs] = CW_ARC + CCW_ARC - kinds[arcs]
+        return EdgeArray(
+            np.where(flip[:, None], edges.ends, edges.starts),
+            np.where(flip[:, None], edges.starts, edges.ends),
+            edges.centers,
+            kinds,
+        )
+
+
+def quantize(values):
+    """Snap coordinates to the TOLERANCE grid, like Point does"""
+    values = np.asarray(values, dtype=np.float64)
+    if TOLERANCE > 0:
+        values = np.round(values / TOLERANCE) * TOLERANCE
+    return values + 0.0  # no negative zeros
 
 
 def extract_edges(commands):
-    edges = []
-    cutting = False
-    current_p = Point(0, 0)
-    for edge in commands:
-        assert "X" in edge
-        assert "Y" in edge
-        assert "D" in edge
-
-        if edge["D"] == "01":
-            cutting = True
-        elif edge["D"] == "02":
-            cutting = False
-        else:
-            raise ValueError(f"Unknown command {edge['D']}")
-
-        if not cutting:
-            current_p = Point(edge["X"], edge["Y"])
-            continue
+    codes, ds, coords = commands
+    unknown = (ds != 1) & (ds != 2)
+    if unknown.any():
+        raise ValueError(f"Unknown command {ds[unknown][0]:02}")
+
+    # every block moves to its point, cutting (D01) from the previous one
+    points = quantize(coords[:, :2])
+    previous = np.vstack([np.zeros((1, 2)), points[:-1]])
+    cuts = ds == 1
+    starts = previous[cuts]
+    ends = points[cuts]
+    centers = starts + quantize(coords[cuts, 2:])
+    kinds = (codes[cuts] - 1).astype(np.int8)  # G01-G03 to LINE, CW_ARC, CCW_ARC
+    return EdgeArray(starts, ends, centers, kinds)
 
-        start_p = current_p
-        current_p = Point(edge["X"], edge["Y"])
 
-        if edge["code"] == "G01":
-            edges.append(Line(start_p, current_p))
-        elif edge["code"] == "G02":
-            edges.append(
-                Arc(start_p, current_p, start_p + Point(edge["I"], edge["J"]), True)
-            )
-        elif edge["code"] == "G03":
-            edges.append(
-                Arc(start_p, current_p, start_p + Point(edge["I"], edge["J"]), False)
-            )
-        else:
-            raise ValueError(f"Unknown command {edge['code']}")
-    return edges
-
-
-def create_path(edges):
-    linked_edges = [edges[0]]
-    unlinked_edges = edges[1:]
-    last_remaining_edges = 0
-    while last_remaining_edges != len(unlinked_edges):
-        last_remaining_edges = len(unlinked_edges)
-        for edge in unlinked_edges:
-            if linked_edges[-1].end == edge.start:
-                print(f"Appending edge {edge} to the end of path")
-                linked_edges.append(edge)
-                unlinked_edges.remove(edge)
-                continue
-            if linked_edges[0].start == edge.end:
-                print(f"Prepending edge {edge} to the start of path")
-                linked_edges.insert(0, edge)
-                unlinked_edges.remove(edge)
-                continue
-            if linked_edges[0].start == edge.start:
-                print(f"Reversing edge {edge} and prepending to the start of path")
-                if isinstance(edge, Line):
-                    linked_edges.insert(0, Line(edge.end, edge.start))
-                else:
-                    linked_edges.insert(
-                        0, Arc(edge.end, edge.start, edge.center, not edge.clockwise)
-                    )
-                unlinked_edges.remove(edge)
-                continue
-            if linked_edges[-1].end == edge.end:
-                print(f"Reversing edge {edge} and appending to the end of path")
-                if isinstance(edge, Line):
-                    linked_edges.append(Line(edge.end, edge.start))
-                else:
-                    linked_edges.append(
-                        Arc(edge.end, edge.start, edge.center, not edge.clockwise)
-                    )
-                unlinked_edges.remove(edge)
-                continue
-            print(f"Edge {edge} is not connected to the path")
-
-    if linked_edges[0].start != linked_edges[-1].end:
-        print("Warning: path is not closed")
-        input("Press Enter to continue...")
-
-    return linked_edges, unlinked_edges
+def path_to_polygon(edges):
+    return Polygon(np.vstack([edges.starts, edges.ends[-1:]]))
 
 
-def path_to_polygon(edges):
-    points = [edge.start for edge in edges] + [edges[-1].end]
-    return Polygon([(p.x, p.y) for p in points])
+def polygon_to_coords(polygon):
+    return quantize(np.asarray(polygon.exterior.coords))
 
 
-def polygon_to_path(polygon):
-    exterior_coords = list(polygon.exterior.coords)
-    edges = []
-    for i in range(len(exterior_coords) - 1):
-        p1 = exterior_coords[i]
-        p2 = exterior_coords[i + 1]
-        edges.append(Line(Point(*p1), Point(*p2)))
-    return edges
+def arc_resolution(radius: float, default=16):
+    """Segments per quarter circle to keep an arc within CHORD_TOLERANCE"""
+    if CHORD_TOLERANCE <= 0 or radius <= 0:
+        return default
+    if CHORD_TOLERANCE >= radius:
+        return 4
+    step = 2 * math.acos(1 - CHORD_TOLERANCE / radius)  # angle of a chord
+    return max(4, math.ceil(math.pi / 2 / step))
 
 
 def offset_polygon(polygon, distance: float):
     # Offset the polygon using Shapely's buffer method
-    offset_polygon = polygon.buffer(distance, resolution=16)
+    # the rounded corners it adds have the offset distance as radius
+    offset_polygon = polygon.buffer(distance, resolution=arc_resolution(abs(distance)))
 
     if not offset_polygon.is_valid or offset_polygon.is_empty:
         raise ValueError("Offset too large, path disappears")
     return offset_polygon
 
 
-def offset_path(edges, distance: float):
-    """
-    Offsets a closed path inward or outward.
-
-    :param edges: List of svgpathtools Path segment objects (Line, Arc)
-    :param distance: Positive for outward, negative for inward
-    :return: List of offset Path segments
-    """
-    # Convert edges to Shapely polygon
-    polygon = path_to_polygon(edges)
-
-    # Offset the polygon
-    offset = offset_polygon(polygon, distance)
+def _sample_arc(cx, cy, r, a0, a1, n):
+    """Sample `n` points on a circle between angles `a0` and `a1`"""
+    angles = np.linspace(a0, a1, n)
+    return cx + r * np.cos(angles), cy + r * np.sin(angles)
 
-    # Convert offset polygon back to path
-    offset_edges = polygon_to_path(offset)
 
-    return offset_edges
+if njit is not None:
+    _sample_arc = njit(cache=True, fastmath=True)(_sample_arc)
 
 
-def approximate_arc(arc, num_segments=20):
+def approximate_arc(start, end, center, clockwise: bool, num_segments=20):
     """
-    Approximate an Arc with a series of Line segments.
-
-    :param arc: svgpathtools.Arc object
-    :param num_segments: Number of line segments to approximate the arc
-    :return: List of svgpathtools.Line objects
+    Approximate an arc with a series of line segments.
+
+    :param start: (x, y) start of the arc
+    :param end: (x, y) end of the arc
+    :param center: (x, y) center of the arc
+    :param clockwise: Direction of the arc
+    :param num_segments: Number of points to sample along the arc
+    :return: EdgeArray of lines
     """
-    points = []
-
-    start = complex(arc.start.x, arc.start.y)
-    end = complex(arc.end.x, arc.end.y)
-    center = complex(arc.center.x, arc.center.y)
+    cx, cy = center
 
     # Compute the radius
-    radius = abs(center - start)
+    radius = math.hypot(start[0] - cx, start[1] - cy)
 
     # Convert start/end points to angles relative to the center
-    start_angle = np.angle(start - center)
-    end_angle = np.angle(end - center)
+    start_angle = math.atan2(start[1] - cy, start[0] - cx)
+    end_angle = math.atan2(end[1] - cy, end[0] - cx)
 
     # Ensure correct sweep direction
-    if not arc.clockwise:
+    if not clockwise:
         if end_angle < start_angle:
-            end_angle += 2 * np.pi
+            end_angle += 2 * math.pi
     else:
         if end_angle > start_angle:
-            end_angle -= 2 * np.pi
+            end_angle -= 2 * math.pi
 
-    print(f"Approximating arc from {start_angle} to {end_angle}")
+    log.debug("Approximating arc from %s to %s", start_angle, end_angle)
 
-    # Generate points along the arc
-    angles = np.linspace(start_angle, end_angle, num_segments)
-    for angle in angles:
-        point = center + radius * cmath.exp(1j * angle)
-        points.append(Point(point.real, point.imag))
-
-    # Convert points to line segments
-    lines = [Line(points[i], points[i + 1]) for i in range(len(points) - 1)]
-    return lines
+    # Generate points along the arc and join them with lines
+    xs, ys = _sample_arc(cx, cy, radius, start_angle, end_angle, num_segments)
+    return EdgeArray.polyline(quantize(np.column_stack((xs, ys))))
 
 
 def segment_path(edges):
-    new_edges = []
-    for edge in edges:
-        if isinstance(edge, Line):
-            new_edges.append(edge)
-        elif isinstance(edge, Arc):
-            new_edges += approximate_arc(edge)
-    return new_edges
+    """Replace the arcs in a path with line segments"""
+    pieces = []
+    last = 0
+    for i in np.flatnonzero(edges.kinds != LINE).tolist():
+        pieces.append(edges[last:i])
+        pieces.append(
+            approximate_arc(
+                edges.starts[i].tolist(),
+                edges.ends[i].tolist(),
+                edges.centers[i].tolist(),
+                edges.kinds[i] == CW_ARC,
+            )
+        )
+        last = i + 1
+    if last == 0:
+        return edges
+    pieces.append(edges[last:])
+    return EdgeArray.concatenate(pieces)
 
 
-def find_closest_edge(edges: list, point: Point) -> int:
-    closest_i = None
-    closest_dist = float("inf")
-    for i in range(len(edges)):
-        edge = edges[i]
-        dist = abs(complex(edge.start.x, edge.start.y) - complex(point.x, point.y))
-        if dist < closest_dist:
-            closest_i = i
-            closest_dist = dist
-    assert closest_i is not None
-    return closest_i
+def find_closest_edge(edges: EdgeArray, point: Point) -> int:
+    assert len(edges) > 0
+    starts = edges.starts
+    dist = (starts[:, 0] - point.x) ** 2 + (starts[:, 1] - point.y) ** 2
+    return int(np.argmin(dist))
 
 
-def reorder_edges(edges: list, start: int) -> list:
-    return edges[start:] + edges[:start]
+def reorder_edges(edges: EdgeArray, start: int) -> EdgeArray:
+    return edges[np.roll(np.arange(len(edges)), -start)]
 
 
 def generate_header(args):
@@ -345,8 +337,13 @@ def generate_footer(args):
 M30; End of program"""
 
 
-def generate_route_gcode(edges, args, polygon_index):
+# G-code formatters, 0.1 um is finer than any router can position
+LINE_FMT = "G01 X{:.4f} Y{:.4f};\n".format
+MOVE_FMT = "G00 X{:.4f} Y{:.4f};\n".format
 
+
+def write_route_gcode(file, coords, args, polygon_index):
+    """Route a ring of points joined by lines, in passes down to the depth"""
     depth_total = abs(args.end - args.start)
     depth = depth_total
     if args.depth:
@@ -359,80 +356,232 @@ def generate_route_gcode(edges, args, polygon_index):
     print(f"Number of passes: {passes}")
     print(f"Pass depth: {pass_depth:.3}mm")
 
-    output = f"G00 Z{args.retract};\n"
-    output += f"G00 X{edges[0].start.x} Y{edges[0].start.y};\n"
+    coords = coords.tolist()
+    file.write(f"G00 Z{args.retract:.4f};\n" + MOVE_FMT(*coords[0]))
+
+    # every pass follows the same contour, so only format it once
+    contour = "".join(starmap(LINE_FMT, coords[1:]))
 
     start_z = args.start
     end_z = args.start - pass_depth
 
     for r in range(passes):
 
-        output += f"; Polygon {polygon_index} - Pass {r + 1} of {passes}\n"
-        output += f"G00 Z{start_z};\nG01 Z{end_z};\n"
-
-        for edge in edges:
-            if isinstance(edge, Line):
-                output += f"G01 X{edge.end.x} Y{edge.end.y};\n"
-            elif isinstance(edge, Arc) and edge.clockwise:
-                center_offset = edge.center - edge.start
-                output += f"G02 X{edge.end.x} Y{edge.end.y} I{center_offset.x} J{center_offset.y};\n"
-            elif isinstance(edge, Arc) and not edge.clockwise:
-                center_offset = edge.center - edge.start
-                output += f"G03 X{edge.end.x} Y{edge.end.y} I{center_offset.x} J{center_offset.y};\n"
-            else:
-                raise ValueError(f"Unknown edge type {edge}")
+        file.write(f"; Polygon {polygon_index} - Pass {r + 1} of {passes}\n")
+        file.write(f"G00 Z{start_z:.4f};\nG01 Z{end_z:.4f};\n")
+        file.write(contour)
 
         start_z = end_z
         end_z -= pass_depth
 
-    output += f"G00 Z{args.retract};\n"
-    return output
+    file.write(f"G00 Z{args.retract:.4f};\n")
+
+
+def _link_paths(start_ids, end_ids, start_ptr, by_start, end_ptr, by_end):
+    """
+    Chain edges into paths, each grown forward from the end of its first
+    edge and then backward from its start, taking the lowest unused index.
+
+    :param start_ids: Endpoint id of the start of each edge
+    :param end_ids: Endpoint id of the end of each edge
+    :param start_ptr: Offsets into `by_start` for each endpoint id
+    :param by_start: Edge indices grouped by start id, lowest index first
+    :param end_ptr: Offsets into `by_end` for each endpoint id
+    :param by_end: Edge indices grouped by end id, lowest index first
+    :return: Edge order, reversed flags, path offsets into the order and
+        whether each path is closed
+    """
+    n = start_ids.shape[0]
+    used = np.zeros(n, dtype=np.bool_)
+    # next candidate of each endpoint, used edges are skipped lazily
+    start_next = start_ptr[:-1].copy()
+    end_next = end_ptr[:-1].copy()
+    order = np.empty(n, dtype=np.int64)
+    reverse = np.zeros(n, dtype=np.bool_)
+    bounds = np.zeros(n + 1, dtype=np.int64)
+    closed = np.zeros(n, dtype=np.bool_)
+    prepended = np.empty(n, dtype=np.int64)
+    flipped = np.empty(n, dtype=np.bool_)
+    k = 0
+    paths = 0
+    for first in range(n):
+        if used[first]:
+            continue
+        used[first] = True
+
+        # walk forward from the end of the first edge
+        forward = [first]
+        forward_flips = [False]
+        tail = end_ids[first]
+        while True:
+            i = -1
+            flip = False
+            while start_next[tail] < start_ptr[tail + 1]:
+                j = by_start[start_next[tail]]
+                start_next[tail] += 1
+                if not used[j]:
+                    i = j
+                    break
+            if i < 0:
+                flip = True
+                while end_next[tail] < end_ptr[tail + 1]:
+                    j = by_end[end_next[tail]]
+                    end_next[tail] += 1
+                    if not used[j]:
+                        i = j
+                        break
+            if i < 0:
+                break
+            used[i] = True
+            forward.append(i)
+            forward_flips.append(flip)
+            tail = start_ids[i] if flip else end_ids[i]
+
+        # then backward from the start of the first edge
+        m = 0
+        head = start_ids[first]
+        while True:
+            i = -1
+            flip = False
+            while end_next[head] < end_ptr[head + 1]:
+                j = by_end[end_next[head]]
+                end_next[head] += 1
+                if not used[j]:
+                    i = j
+                    break
+            if i < 0:
+                flip = True
+                while start_next[head] < start_ptr[head + 1]:
+                    j = by_start[start_next[head]]
+                    start_next[head] += 1
+                    if not used[j]:
+                        i = j
+                        break
+            if i < 0:
+                break
+            used[i] = True
+            prepended[m] = i
+            flipped[m] = flip
+            m += 1
+            head = end_ids[i] if flip else start_ids[i]
+
+        for j in range(m - 1, -1, -1):
+            order[k] = prepended[j]
+            reverse[k] = flipped[j]
+            k += 1
+        for j in range(len(forward)):
+            order[k] = forward[j]
+            reverse[k] = forward_flips[j]
+            k += 1
+        closed[paths] = head == tail
+        paths += 1
+        bounds[paths] = k
+    return order, reverse, bounds[: paths + 1], closed[:paths]
+
+
+if njit is not None:
+    _link_paths = njit(cache=True)(_link_paths)
+
+
+def group_edges(ids, count: int):
+    """Edge indices grouped by endpoint id, with the offset of each group"""
+    grouped = np.argsort(ids, kind="stable")
+    ptr = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ids, minlength=count), out=ptr[1:])
+    return ptr, grouped
+
+
+def endpoint_keys(points):
+    """
+    One integer key per point, equal for points on the same grid position.
+
+    :param points: (N, 2) coordinates, already snapped to the TOLERANCE grid
+    :return: (N,) int64 keys packing the x and y grid steps
+    """
+    if TOLERANCE <= 0:
+        return points[:, 0] + 1j * points[:, 1]  # no grid, compare exactly
+    steps = np.rint(points / TOLERANCE).astype(np.int64)
+    return (steps[:, 0] << 32) ^ (steps[:, 1] & 0xFFFFFFFF)
 
 
 def link_edges(edges):
+    # number the distinct endpoints, so that the kernel can index by them
+    keys = endpoint_keys(np.vstack([edges.starts, edges.ends]))
+    unique, ids = np.unique(keys, return_inverse=True)
+    ids = ids.astype(np.int64)
+    start_ids = ids[: len(edges)]
+    end_ids = ids[len(edges) :]
+    order, reverse, bounds, closed = _link_paths(
+        start_ids,
+        end_ids,
+        *group_edges(start_ids, len(unique)),
+        *group_edges(end_ids, len(unique)),
+    )
     paths = []
-    path, unlinked_edges = create_path(edges)
-    paths.append(path)
-    last_remaining_edges = 0
-    while len(unlinked_edges) > 0 and len(unlinked_edges) != last_remaining_edges:
-        last_remaining_edges = len(unlinked_edges)
-        path, unlinked_edges = create_path(unlinked_edges)
-        paths.append(path)
+    for k in range(len(closed)):
+        if not closed[k]:
+            print("Warning: path is not closed")
+            input("Press Enter to continue...")
+        path = slice(bounds[k], bounds[k + 1])
+        paths.append(edges.take(order[path], reverse[path]))
     return paths
 
 
+def paths_to_polygons(paths: list):
+    """Build the polygons of many paths in one call into Shapely"""
+    rings = [np.vstack([edges.starts, edges.ends[-1:]]) for edges in paths]
+    indices = np.repeat(np.arange(len(rings)), [len(ring) for ring in rings])
+    rings = shapely.linearrings(np.vstack(rings), indices=indices)
+    return shapely.polygons(rings).tolist()
+
+
 def create_polygons(paths, entry):
-    polygons = []
+    segmented = []
     for i, edges in enumerate(paths):
         closest_edge = find_closest_edge(edges, entry)
 
         edges = reorder_edges(edges, closest_edge)
         edges = segment_path(edges)
+        segmented.append(edges)
+
+    if not segmented:
+        return []
+    try:
+        polygons = paths_to_polygons(segmented)
+    except ValueError:
+        # convert them one at a time to skip the broken ones
+        polygons = []
+        for edges in segmented:
+            try:
+                polygon = path_to_polygon(edges)
+            except ValueError as e:
+                print(f"Warning:  path to polygon conversion failed: {e}")
+                # TODO: handle slot_width == tool diameter
+                continue
+            polygons.append(polygon)
 
-        try:
-            polygon = path_to_polygon(edges)
-        except ValueError as e:
-            print(f"Warning:  path to polygon conversion failed: {e}")
-            # TODO: handle slot_width == tool diameter
-            continue
-        polygons.append(polygon)
+    # drop vertices within CHORD_TOLERANCE of a straight line, like
+    # collinear points and the samples of flat arcs, before they get offset
+    if CHORD_TOLERANCE > 0 and polygons:
+        polygons = shapely.simplify(polygons, CHORD_TOLERANCE).tolist()
     return polygons
 
 
 def sort_polygons(polygons):
-    sorted_polygons = sorted(polygons, key=Within, reverse=True)
-    # add levels to the sorted polygons
+    # add levels to the polygons, the number of polygons each one is within
     # odd levels are inside, even levels are outside
-    levels = [0] * len(sorted_polygons)
-    for i in range(len(sorted_polygons)):
-        for j in range(i):
-            if sorted_polygons[j].contains(sorted_polygons[i]):
-                levels[i] += 1
+    tree = STRtree(polygons)
+    outer, inner = tree.query(tree.geometries, predicate="contains")
+    # a polygon is not its own container, and zero area ones do not even
+    # contain themselves, so drop the self pairs rather than subtract one
+    # equal polygons contain each other, only the later one is nested
+    n = len(polygons)
+    mutual = np.isin(inner * n + outer, outer * n + inner)
+    nested = (outer != inner) & (~mutual | (outer < inner))
+    levels = np.bincount(inner[nested], minlength=n).tolist()
 
     # sort by level from deepest to shallowest
-    sorted_polygons = sorted(
-        zip(sorted_polygons, levels), key=lambda x: x[1], reverse=True
-    )
+    sorted_polygons = sorted(zip(polygons, levels), key=lambda x: x[1], reverse=True)
     return sorted_polygons
 
 
@@ -463,8 +612,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "--tolerance", type=float, default=TOLERANCE, help="Tolerance for path joining"
     )
+    parser.add_argument(
+        "--chord-tolerance",
+        type=float,
+        default=CHORD_TOLERANCE,
+        help="Max deviation of simplified outlines and of offset corners, "
+        "each, from the exact shape",
+    )
     args = parser.parse_args()
     TOLERANCE = args.tolerance
+    CHORD_TOLERANCE = args.chord_tolerance
 
     if not args.output:
         args.output = ".".join(args.input.split(".")[0:-1]) + ".nc"
@@ -479,29 +636,27 @@ if __name__ == "__main__":
     polygons = create_polygons(paths, entry)
     sorted_polygons = sort_polygons(polygons)
 
-    output = generate_header(args)
-    n = 0
-    for polygon, level in sorted_polygons:
-        direction = 1.0 if level % 2 == 0 else -1.0
-        try:
-            offset = offset_polygon(polygon, direction * args.tool / 2.0)
-        except ValueError as e:
-            print(f"Warning:  offsetting polygon failed: {e}")
-            print("\tFix by using a smaller tool diameter")
-            continue
-        try:
-            edges = polygon_to_path(offset)
-        except Exception as e:
-            print(f"Warning:  polygon to path conversion failed: {e}")
-            # TODO: handle slot_width == tool diameter
-            continue
-
-        output += generate_route_gcode(edges, args, n)
-        n += 1
+    with open(args.output, "w", buffering=1 << 20) as file:
+        file.write(generate_header(args))
+        n = 0
+        for polygon, level in sorted_polygons:
+            direction = 1.0 if level % 2 == 0 else -1.0
+            try:
+                offset = offset_polygon(polygon, direction * args.tool / 2.0)
+            except ValueError as e:
+                print(f"Warning:  offsetting polygon failed: {e}")
+                print("\tFix by using a smaller tool diameter")
+                continue
+            try:
+                coords = polygon_to_coords(offset)
+            except Exception as e:
+                print(f"Warning:  polygon to path conversion failed: {e}")
+                # TODO: handle slot_width == tool diameter
+                continue
 
-    output += generate_footer(args)
+            write_route_gcode(file, coords, args, n)
+            n += 1
 
-    with open(args.output, "w") as file:
-        file.write(output)
+        file.write(generate_footer(args))
 
     print("GCode generated successfully")